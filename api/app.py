@@ -1,74 +1,122 @@
+import asyncio
 import random
 import os
 import re
 import nltk
-from nltk.tokenize import sent_tokenize
-import boto3
 import tiktoken
 from dotenv import load_dotenv
-from flask import Flask, request, jsonify
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+from quart import Quart, request, jsonify  # async version of flask (ASGI), same API
 from epubcheck import EpubCheck  # to check validity of epub file
 
-from api.lm_quiz_generation import prompt_model
-from api.parse_hrefs import get_content
+from api.lm_quiz_generation import prompt_model_async
+from api.parse_hrefs import get_content_async
+from api.passage_selection import select_passages, split_parts, token_counts
+from api.question_dedup import deduplicate_quizzes
+from api.quiz_cache import is_valid_question, quiz_from_banks_async
+from api.storage import (book_exists, book_key, delete_object, move_object, new_upload_id, object_sha256,
+                         presigned_download, presigned_upload, upload_key)
 
 load_dotenv()
 
 nltk.download('punkt')  # for sentence tokenization
 
-app = Flask(__name__, static_folder='../build', static_url_path='/')
+app = Quart(__name__, static_folder='../build', static_url_path='/')
 
+# cpu-bound work (parsing epub files, selecting passages) runs in other processes, so the event loop stays free
+# to handle other requests while waiting for LLMs, Redis or Spaces
+# workers are started lazily, when the server already runs threads (asyncio.to_thread), and forking a process with
+# threads can deadlock the child, so they are started from a fork server instead
+executor = ProcessPoolExecutor(max_workers=int(os.getenv('PARSE_WORKERS', 2)),
+                               mp_context=multiprocessing.get_context('forkserver'))
 
-@app.route('/')
-def index():
-    return app.send_static_file('index.html')  # serve react app
-
-
-# s3 client for digitalocean spaces
-session = boto3.session.Session()
-client = session.client('s3',
-                        region_name='fra1',
-                        endpoint_url='https://nyc3.digitaloceanspaces.com',
-                        aws_access_key_id=os.getenv('SPACES_KEY'),
-                        aws_secret_access_key=os.getenv('SPACES_SECRET'))
 
-# spaces bucket name
-BUCKET_NAME = os.getenv('BUCKET_NAME')
+@app.route('/')
+async def index():
+    return await app.send_static_file('index.html')  # serve react app
 
 
 # simple authentication with password
 @app.route('/api/authenticate', methods=['POST'])
-def authenticate():
-    if request.json.get('password') == os.getenv('WEB_PASS'):  # password will be encrypted env variable on digitalocean
+async def authenticate():
+    if (await request.get_json()).get('password') == os.getenv('WEB_PASS'):  # password will be encrypted env variable on digitalocean
         return {'authenticated': True}, 200  # ok
     else:
         return {'authenticated': False}, 401  # unauthorized, wrong password
 
 
-# upload epub file to DigitalOcean spaces and return URL
+# check the SHA-256 hash of an epub file sent by the browser
+def valid_sha256(sha256):
+    return isinstance(sha256, str) and re.fullmatch(r'[0-9a-f]{64}', sha256) is not None
+
+
+# check the id of an upload (see new_upload_id)
+def valid_upload_id(upload_id):
+    return isinstance(upload_id, str) and re.fullmatch(r'[0-9a-f]{32}', upload_id) is not None
+
+
+# only the server stores books under their hash, after checking the hash (see complete_upload)
+async def book_stored(sha256):
+    return await asyncio.to_thread(book_exists, book_key(sha256))  # boto3 is blocking, so run it in a thread
+
+
+# the browser uploads epub files directly to DigitalOcean spaces (so the file does not go through the server),
+# books are stored with the hash of the content as name, so every book is stored only once
 @app.route('/api/upload', methods=['POST'])
-def upload_file():
-    file = request.files['file']
-    if file.filename == '':
+async def request_upload():
+    data = await request.get_json()
+    if not valid_sha256(data.get('sha256')):
+        return jsonify(
+            {'message': 'No file selected'}), 400
+
+    try:
+        # if the same book was uploaded before (by anyone), skip the upload
+        if await book_stored(data['sha256']):
+            return jsonify({'exists': True}), 200
+
+        # upload to a key of its own, the book is moved to its hash once the server has checked the hash
+        upload_id = new_upload_id()
+        return jsonify({'exists': False, 'upload_id': upload_id,
+                        'upload': presigned_upload(upload_key(upload_id))}), 200  # url and form fields for the upload
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500  # return JSON error response (500 means Internal Server Error)
+
+
+# after the upload (or if the book exists already), check the hash, store the book under it and return URL
+@app.route('/api/upload/complete', methods=['POST'])
+async def complete_upload():
+    data = await request.get_json()
+    if not valid_sha256(data.get('sha256')):
         return jsonify(
             {'message': 'No file selected'}), 400
 
     # check if user wants to validate epub
-    check_validity = request.form.get('check_validity') == 'true'
+    check_validity = data.get('check_validity') is True
 
-    # upload file to digitalocean spaces
     try:
-        client.upload_fileobj(file, BUCKET_NAME, file.filename)
-
-        # create presigned URL for the file
-        url = client.generate_presigned_url('get_object',
-                                            Params={'Bucket': BUCKET_NAME,
-                                                    'Key': file.filename},
-                                            ExpiresIn=3600 * 24)  # 24 hours
+        key = book_key(data['sha256'])
+        stored = await book_stored(data['sha256'])
+
+        if stored:
+            source = key
+        else:
+            if not valid_upload_id(data.get('upload_id')):
+                return jsonify({'message': 'Upload failed. Please try again.'}), 404
+            source = upload_key(data['upload_id'])
+            if not await asyncio.to_thread(book_exists, source):
+                return jsonify({'message': 'Upload failed. Please try again.'}), 404
+
+            # the hash comes from the browser, so check it before the book is shared with everyone under that hash
+            # (streams the whole file, so it runs in a thread)
+            if await asyncio.to_thread(object_sha256, source) != data['sha256']:
+                await asyncio.to_thread(delete_object, source)
+                return jsonify({'message': 'The uploaded file does not match its hash. Please try again.'}), 422
 
         if check_validity:
             # check if epub is valid (but takes a long time)
-            result = EpubCheck(url)
+            result = await asyncio.to_thread(EpubCheck, presigned_download(source))
             if not result.valid:
                 # check if level='FATAL' in result.result_data dict in messages
                 # usually errors below severity 'FATAL' are not that important
@@ -77,9 +125,18 @@ def upload_file():
                 for msg in messages:
                     if msg.get('severity') == 'FATAL':
                         print('FATAL ERROR:', msg)
+                        if not stored:  # invalid books are not stored
+                            await asyncio.to_thread(delete_object, source)
                         return jsonify({
                             'message': 'Your epub file is not valid. Please try again with another file.'}), 422  # unprocessable entity
 
+        if not stored:
+            # share the checked book under its hash
+            await asyncio.to_thread(move_object, source, key)
+
+        # create presigned URL for the file
+        url = presigned_download(key)
+
         return jsonify({'file_url': url}), 200  # return JSON response (200 means OK)
 
     except Exception as e:
@@ -88,11 +145,8 @@ def upload_file():
 
 # verify if quiz content contains all necessary keys
 def check_quiz_content(quiz, num_questions):
-    question_keys = ['question', 'correct_answer', 'options', 'explanation', 'answer_location', 'href',
-                     'question_number']
-
     for question in quiz['questions']:
-        if not all(question.get(key) for key in question_keys):  # check if all keys are included
+        if not is_valid_question(question):  # check if all keys are included
             return False
 
     if len(quiz['questions']) != num_questions:  # check if we have the correct amount of questions
@@ -103,15 +157,22 @@ def check_quiz_content(quiz, num_questions):
 
 # quiz generation logic (maximum tokens, what happens if content is too long)
 @app.route('/api/generate_quiz', methods=['POST'])
-def generate_quiz():  # server sends ebook url (ebookUrl, hrefs (selectedChapters) and number of questions (numQuestions)
+async def generate_quiz():  # server sends ebook url (ebookUrl, hrefs (selectedChapters) and number of questions (numQuestions)
+    data = await request.get_json()
 
-    # use get_content from parse_hrefs.py to get text content of hrefs
-    content = get_content(request.json['selectedChapters'], request.json['ebookUrl'])
+    # serve quiz instantly if questions were pre-generated for all selected chapters (see batch_generate.py)
+    quiz = await quiz_from_banks_async(data['ebookUrl'], data['selectedChapters'], int(data['numQuestions']))
+    if quiz is not None and check_quiz_content(quiz, int(data['numQuestions'])):
+        print('[INFO] served quiz from question banks')
+        return jsonify(quiz), 200
+
+    # use get_content_async from parse_hrefs.py to get text content of hrefs
+    content = await get_content_async(data['selectedChapters'], data['ebookUrl'], executor)
     concatenated_content = ' '.join(content)
 
     # count tokens in the concatenated content
     enc = tiktoken.encoding_for_model('gpt-3.5-turbo-0125')  # encoding for gpt-5.5-turbo
-    num_tokens = len(enc.encode(concatenated_content))
+    num_tokens = len(await asyncio.to_thread(enc.encode, concatenated_content))  # tiktoken releases the GIL
 
     # change approach if you do not want to use Gemini for too long content
     # approach = 'split_parts'
@@ -122,87 +183,36 @@ def generate_quiz():  # server sends ebook url (ebookUrl, hrefs (selectedChapter
     token_limit = 13800  # for chapter content; (total context window of gpt-3.5 is approx 16k tokens, including prompt + output)
     retry_count = 0
 
+    # for large selections, only send the most informative passages to the model (one or two parts instead of many)
+    # set passage_budget to None if you want to send all content
+    passage_budget = 2 * token_limit
+    if passage_budget and num_tokens > passage_budget and approach in ('split_parts', 'random_chapters'):
+        content = await asyncio.get_running_loop().run_in_executor(executor, select_passages, content,
+                                                                   passage_budget)
+        concatenated_content = ' '.join(content)
+        num_tokens = len(await asyncio.to_thread(enc.encode, concatenated_content))  # tokens sent to the model
+
     while True:
         # different approaches to test when content above token limit
         if num_tokens > token_limit:
             if approach == 'split_parts':  # splits parts into chunks with tokens less than token limit
 
-                # calculate tokens in each content part
-                content_counts = [len(enc.encode(part)) for part in content]
-
-                # split content into parts under token limit
-                content_parts = []
-                current_part = ''
-                current_count = 0
-                for i, part in enumerate(
-                        content):  # content_counts[i] is token count for chapter currently being processed
-
-                    if current_count + content_counts[i] > token_limit:  # if adding next chapter would be > limit
-
-                        if current_part:  # if current part is not empty, add it to the list
-                            # add the parts concatenated up until the current chapter (not included)
-                            content_parts.append(current_part)
-                        current_part = ''
-                        current_count = 0
-
-                        # if one chapter alone is already above limit, split into smaller parts
-                        # logic could be improved, but for now we split into sentences
-                        if content_counts[i] > token_limit:
-                            # remove [HREF START:\t.+\t] and [HREF END:\t.+\t] from the part
-                            start_pattern = r'\[HREF START:\t.+\t\]'
-                            end_pattern = r'\[HREF END:\t.+\t\]'
-
-                            # get href start and end, save for later
-                            href_start = re.findall(start_pattern, part)[0]
-                            href_end = re.findall(end_pattern, part)[0]
-
-                            # remove href start and end
-                            part = re.sub(start_pattern, '', part)
-                            part = re.sub(end_pattern, '', part)
-
-                            # tokenize into sentences
-                            sentences = sent_tokenize(part)
-                            current_part = ""
-                            current_token_count = 0
-
-                            # create smaller parts under token limit
-                            for sentence in sentences:
-                                sentence_token_count = len(enc.encode(sentence))
-
-                                # add as long as we are under token limit
-                                if current_token_count + sentence_token_count < token_limit:
-                                    current_part += sentence + " "
-                                    current_token_count += sentence_token_count
-                                else:
-                                    # add to final list (include hrefs)
-                                    current_part = f'[HREF START:\t{href_start}\t]\n' + current_part + f'\n[HREF END:\t{href_end}\t]'
-                                    content_parts.append(current_part.strip())
-                                    current_part = sentence + " "
-                                    current_token_count = sentence_token_count
-
-                            if current_part.strip():  # if there's still something left
-                                current_part = f'[HREF START:\t{href_start}\t]\n' + current_part + f'\n[HREF END:\t{href_end}\t]'
-                                content_parts.append(current_part.strip())
-
-                            continue
-
-                    else:  # if adding next chapter would be <= limit
-                        current_part += part
-                        current_count += content_counts[i]
-
-                content_parts.append(current_part)  # add the last part
+                # split content into parts under token limit (tokenizing takes a while, so in the process pool)
+                content_parts = await asyncio.get_running_loop().run_in_executor(executor, split_parts, content,
+                                                                                 token_limit)
 
                 # check how many parts we have, decide how many questions to get from each part
                 num_parts = len(content_parts)
-                num_per_part = (int(request.json['numQuestions']) // num_parts) + 1  # add 1 as buffer
+                num_per_part = (int(data['numQuestions']) // num_parts) + 1  # add 1 as buffer
+
+                # get quiz for each content part (all parts at the same time)
+                quizzes = await asyncio.gather(*[prompt_model_async(part, num_per_part, options_per_question=4)
+                                                 for part in content_parts])
 
-                # get quiz for each content part
-                quizzes = []
-                for part in content_parts:
-                    quiz = prompt_model(part, num_per_part, options_per_question=4)
-                    quizzes.append(quiz)
+                # overlapping content often leads to (nearly) the same question in several parts
+                quizzes, removed = deduplicate_quizzes(quizzes)
 
-                amount_quest = int(request.json['numQuestions'])
+                amount_quest = int(data['numQuestions'])
                 final_quiz = []
 
                 # we want to return the amount of questions the user asked for,
@@ -210,6 +220,8 @@ def generate_quiz():  # server sends ebook url (ebookUrl, hrefs (selectedChapter
 
                 # randomly select one of the "quizzes" and take one single question, repeat until enough questions
                 for i in range(amount_quest):
+                    if not quizzes:  # not enough questions left after removing duplicates
+                        break
                     quiz = random.choice(quizzes)
                     question = random.choice(quiz['questions'])  # get random question from the quiz
                     quiz['questions'].remove(question)  # delete that question from the quiz so we don't get duplicates
@@ -218,6 +230,10 @@ def generate_quiz():  # server sends ebook url (ebookUrl, hrefs (selectedChapter
                         quizzes.remove(quiz)
                     final_quiz.append(question)
 
+                # fill up with the removed questions that are least similar to the kept ones (instead of generating
+                # all parts again)
+                final_quiz.extend(removed[:amount_quest - len(final_quiz)])
+
                 # put everything together
                 quiz = {'questions': final_quiz}
 
@@ -225,7 +241,7 @@ def generate_quiz():  # server sends ebook url (ebookUrl, hrefs (selectedChapter
                 quiz['model_used'] = 'gpt-3.5-turbo-0125'
                 quiz['total_tokens'] = num_tokens
 
-                if not check_quiz_content(quiz, int(request.json['numQuestions'])):  # restart loop if quiz is not valid
+                if not check_quiz_content(quiz, int(data['numQuestions'])):  # restart loop if quiz is not valid
                     retry_count += 1
                     if retry_count > 3:
                         return jsonify({'error': 'server error'}), 500
@@ -236,15 +252,15 @@ def generate_quiz():  # server sends ebook url (ebookUrl, hrefs (selectedChapter
             elif approach == 'gpt4':  # use gpt-4 for content below 60k tokens, could handle up to 128k
                 if num_tokens < 60000:  # limit for now due to cost
                     # use gpt 4 turbo with 128k tokens context
-                    quiz = prompt_model(concatenated_content, int(request.json['numQuestions']), options_per_question=4,
-                                        model='gpt-4-0125-preview')
+                    quiz = await prompt_model_async(concatenated_content, int(data['numQuestions']),
+                                                    options_per_question=4, model='gpt-4-0125-preview')
 
                     print('[INFO] used gpt-4')
                     quiz['model_used'] = 'gpt-4-0125-preview'
                     quiz['total_tokens'] = num_tokens
 
                     if not check_quiz_content(quiz,
-                                              int(request.json['numQuestions'])):  # restart loop if quiz is not valid
+                                              int(data['numQuestions'])):  # restart loop if quiz is not valid
                         retry_count += 1
                         if retry_count > 3:
                             return jsonify({'error': 'server error'}), 500
@@ -259,8 +275,9 @@ def generate_quiz():  # server sends ebook url (ebookUrl, hrefs (selectedChapter
 
                     gemini_1_max_tokens = 30000  # max tokens for gemini-1.0-pro
 
-                    quiz = prompt_model(concatenated_content, int(request.json['numQuestions']), options_per_question=4,
-                                        model='gemini', num_tokens=num_tokens, gemini_1_max=gemini_1_max_tokens)
+                    quiz = await prompt_model_async(concatenated_content, int(data['numQuestions']),
+                                                    options_per_question=4, model='gemini', num_tokens=num_tokens,
+                                                    gemini_1_max=gemini_1_max_tokens)
 
                     # if quiz is None, return server error
                     if quiz is None:
@@ -278,7 +295,7 @@ def generate_quiz():  # server sends ebook url (ebookUrl, hrefs (selectedChapter
                     quiz['total_tokens'] = num_tokens
 
                     if not check_quiz_content(quiz,
-                                              int(request.json['numQuestions'])):  # restart loop if quiz is not valid
+                                              int(data['numQuestions'])):  # restart loop if quiz is not valid
                         retry_count += 1
                         if retry_count > 3:
                             return jsonify({'error': 'server error'}), 500
@@ -290,7 +307,7 @@ def generate_quiz():  # server sends ebook url (ebookUrl, hrefs (selectedChapter
 
             elif approach == 'random_chapters':  # randomly select chapters until we have 14000 tokens
                 # calculate tokens in each content part
-                content_counts = [len(enc.encode(part)) for part in content]
+                content_counts = await asyncio.get_running_loop().run_in_executor(executor, token_counts, content)
 
                 current_count = 0
                 concatenated_content = ''
@@ -310,7 +327,7 @@ def generate_quiz():  # server sends ebook url (ebookUrl, hrefs (selectedChapter
                     content.pop(random_index)
                     content_counts.pop(random_index)
 
-                quiz = prompt_model(concatenated_content, int(request.json['numQuestions']), options_per_question=4)
+                quiz = await prompt_model_async(concatenated_content, int(data['numQuestions']), options_per_question=4)
 
                 print('[INFO] used random chapters approach with gpt-3.5-turbo-0125')
 
@@ -320,7 +337,7 @@ def generate_quiz():  # server sends ebook url (ebookUrl, hrefs (selectedChapter
                 quiz['model_used'] = 'gpt-3.5-turbo-0125'
                 quiz['total_tokens'] = num_tokens
 
-                if not check_quiz_content(quiz, int(request.json['numQuestions'])):  # restart loop if quiz is not valid
+                if not check_quiz_content(quiz, int(data['numQuestions'])):  # restart loop if quiz is not valid
                     retry_count += 1
                     if retry_count > 3:
                         return jsonify({'error': 'server error'}), 500
@@ -329,13 +346,13 @@ def generate_quiz():  # server sends ebook url (ebookUrl, hrefs (selectedChapter
                 return jsonify(quiz), 200
 
         else:  # if content is less than token limit, use gpt-3.5
-            quiz = prompt_model(concatenated_content, int(request.json['numQuestions']), options_per_question=4)
+            quiz = await prompt_model_async(concatenated_content, int(data['numQuestions']), options_per_question=4)
             quiz['model_used'] = 'gpt-3.5-turbo-0125'
             quiz['total_tokens'] = num_tokens
 
             print('[INFO] used gpt-3.5')
 
-            if not check_quiz_content(quiz, int(request.json['numQuestions'])):  # restart loop if quiz is not valid
+            if not check_quiz_content(quiz, int(data['numQuestions'])):  # restart loop if quiz is not valid
                 retry_count += 1
                 if retry_count > 3:
                     return jsonify({'error': 'server error'}), 500
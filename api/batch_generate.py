@@ -0,0 +1,363 @@
+"""
+Pre-generate question banks for whole books, so that generate_quiz can serve quizzes instantly (e.g. overnight for
+popular books). The book id is the hash of the file content, the same key that the upload uses on Spaces.
+Run from the repository root, for example:
+
+    python -m api.batch_generate books/ --workers 4 --rpm 60
+    python -m api.batch_generate manifest.txt --batch-api    # submit all prompts to the OpenAI Batch API
+    python -m api.batch_generate --collect batch_abc123      # store the results once the batch is completed
+
+Books are written to the checkpoint file once every chapter has a question bank, so an interrupted run (or one with
+failed requests) can be resumed by running the same command again. Books submitted to the Batch API are recorded with
+the batch id and only marked as finished by --collect; books of a failed or expired batch are submitted again on the
+next run. Chapters that already have a question bank in Redis are skipped unless --overwrite is given.
+"""
+import argparse
+import json
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import fix_busted_json
+import nltk
+import openai
+import tiktoken
+from nltk.tokenize import sent_tokenize
+
+from api.lm_quiz_generation import get_prompt, prompt_model
+from api.parse_hrefs import get_content_from_file
+from api.question_dedup import deduplicate_quizzes
+from api.quiz_cache import has_question_bank, is_valid_question, store_question_bank
+from api.storage import book_key, file_sha256
+
+# encoding to count tokens
+enc = tiktoken.encoding_for_model('gpt-3.5-turbo-0125')
+
+MODEL = 'gpt-3.5-turbo-0125'
+TOKEN_LIMIT = 13800  # same as in generate_quiz
+MIN_TOKENS = 200  # no questions for very short chapters (cover, copyright page, ...)
+
+# time of the last request of this worker process, for rate limiting
+_last_request = 0.0
+
+
+def find_books(paths):
+    """
+    Get the EPUB files from a list of paths: directories (searched recursively), EPUB files, or manifests (.txt with
+    one path per line or .json with a list of paths).
+    """
+    books = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                books.extend(os.path.join(root, name) for name in sorted(files) if name.endswith('.epub'))
+        elif path.endswith('.json'):
+            with open(path) as f:
+                books.extend(json.load(f))
+        elif path.endswith('.txt'):
+            with open(path) as f:
+                books.extend(line.strip() for line in f if line.strip())
+        else:
+            books.append(path)
+    return books
+
+
+def split_chapter(chapter, token_limit=TOKEN_LIMIT):
+    """
+    Split the content of one chapter (with HREF markers) into parts under the token limit, along sentences.
+    Returns the href and the list of parts (with HREF markers).
+    """
+    href = re.search(r'\[HREF START:\t([^\t\n]+)\t\]', chapter).group(1)
+    if len(enc.encode(chapter)) <= token_limit:
+        return href, [chapter]
+
+    text = re.sub(r'\[HREF (START|END):\t[^\t\n]+\t\]', '', chapter)
+    parts = []
+    current_part = ''
+    current_token_count = 0
+    for sentence in sent_tokenize(text):
+        sentence_token_count = len(enc.encode(sentence))
+        if current_token_count + sentence_token_count >= token_limit and current_part:
+            parts.append(current_part)
+            current_part = ''
+            current_token_count = 0
+        current_part += sentence + ' '
+        current_token_count += sentence_token_count
+
+    if current_part.strip():  # if there's still something left
+        parts.append(current_part)
+
+    return href, [f'[HREF START:\t{href}\t]\n' + part.strip() + f'\n[HREF END:\t{href}\t]' for part in parts]
+
+
+def book_parts(path, book_id, overwrite=False):
+    """
+    Parse a book and get the parts to generate questions for, as a list of (href, total tokens of href, parts).
+    Very short chapters get an empty question bank instead, so that selections including them can still be served
+    from the question banks.
+    """
+    chapters = []
+    for chapter in get_content_from_file(None, path):
+        href, parts = split_chapter(chapter)
+        if not overwrite and has_question_bank(book_id, href):
+            continue
+        num_tokens = len(enc.encode(chapter))
+        if num_tokens < MIN_TOKENS:
+            store_question_bank(book_id, href, [], MODEL, num_tokens)
+            continue
+        chapters.append((href, num_tokens, parts))
+    return chapters
+
+
+def wait_for_rate_limit(min_interval):
+    """
+    Sleep until at least min_interval seconds have passed since the last request of this process.
+    """
+    global _last_request
+    wait = _last_request + min_interval - time.monotonic()
+    if wait > 0:
+        time.sleep(wait)
+    _last_request = time.monotonic()
+
+
+def store_quizzes(book_id, href, quizzes, num_tokens):
+    """
+    Remove invalid and near-duplicate questions and store the rest as question bank of the href.
+    """
+    for quiz in quizzes:
+        quiz['questions'] = [question for question in quiz.get('questions', []) if is_valid_question(question)]
+    quizzes, _ = deduplicate_quizzes(quizzes)
+    questions = [question for quiz in quizzes for question in quiz['questions']]
+    if questions:
+        store_question_bank(book_id, href, questions, MODEL, num_tokens)
+    return len(questions)
+
+
+def generate_book(path, num_questions, min_interval, overwrite):
+    """
+    Generate and store the question banks of all chapters of a book (runs in a worker process).
+    Returns the number of stored banks and the hrefs without bank (failed requests), which are tried again next time.
+    """
+    book_id = book_key(file_sha256(path))
+    num_banks = 0
+    missing = []
+    for href, num_tokens, parts in book_parts(path, book_id, overwrite):
+        quizzes = []
+        for part in parts:
+            wait_for_rate_limit(min_interval)
+            quizzes.append(prompt_model(part, num_questions, options_per_question=4, model=MODEL))
+
+        # only store complete banks, otherwise the missing parts would never be generated (bank exists)
+        if any(quiz is None for quiz in quizzes):
+            print(f'Error for {book_id} {href}: no response for {quizzes.count(None)} of {len(parts)} parts')
+            missing.append(href)
+            continue
+
+        num_stored = store_quizzes(book_id, href, quizzes, num_tokens)
+        print(f'[INFO] {book_id}: {num_stored} questions for {href}')
+        if num_stored:
+            num_banks += 1
+        else:
+            missing.append(href)
+    return num_banks, missing
+
+
+def batch_requests(path, num_questions, overwrite):
+    """
+    Create the requests for the OpenAI Batch API for all chapters of a book (runs in a worker process).
+    Returns the book id, the number of parts per href and the requests.
+    """
+    book_id = book_key(file_sha256(path))
+    hrefs = {}
+    requests = []
+    for href, num_tokens, parts in book_parts(path, book_id, overwrite):
+        hrefs[href] = len(parts)
+        for i, part in enumerate(parts):
+            messages = [{'role': 'system', 'content': 'You are a helpful assistant designed to output JSON.'},
+                        {'role': 'user', 'content': get_prompt(part, num_questions, options_per_question=4)}]
+            requests.append({'custom_id': json.dumps([book_id, href, num_tokens, i]),
+                             'method': 'POST',
+                             'url': '/v1/chat/completions',
+                             'body': {'model': MODEL, 'response_format': {'type': 'json_object'},
+                                      'messages': messages}})
+    return book_id, hrefs, requests
+
+
+def read_checkpoint(checkpoint):
+    """
+    Read all entries of the checkpoint file: finished books ({'book': path}), submitted batches ({'batch_id': id,
+    'books': {path: [book id, {href: number of parts}]}}) and collected batches ({'collected': id}).
+    """
+    if not os.path.exists(checkpoint):
+        return []
+    with open(checkpoint) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def load_checkpoint(checkpoint):
+    """
+    Get the finished books and the books of submitted batches that were not collected yet.
+    """
+    entries = read_checkpoint(checkpoint)
+    done = {entry['book'] for entry in entries if 'book' in entry}
+    collected = {entry['collected'] for entry in entries if 'collected' in entry}
+    pending = {path for entry in entries if 'batch_id' in entry and entry['batch_id'] not in collected
+               for path in entry['books']}
+    return done, pending
+
+
+def save_checkpoint(checkpoint, **entry):
+    with open(checkpoint, 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+
+
+def run_books(books, args):
+    """
+    Generate question banks for all books with a process pool, calling the model directly.
+    """
+    # every worker gets the same share of the rate limit
+    min_interval = 60 * args.workers / args.rpm
+
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(generate_book, path, args.questions, min_interval, args.overwrite): path
+                   for path in books}
+        for future in as_completed(futures):
+            path = futures[future]
+            try:
+                num_banks, missing = future.result()
+            except Exception as e:
+                # not saved in checkpoint, so the book will be tried again when resuming
+                print(f'Error for {path}: {e}')
+                continue
+            if missing:
+                print(f'Error for {path}: no question banks for {len(missing)} chapters, will be tried again')
+                continue
+            save_checkpoint(args.checkpoint, book=path)
+            print(f'[INFO] finished {path} ({num_banks} question banks)')
+
+
+def submit_batch(books, args):
+    """
+    Parse all books with a process pool and submit all prompts as one job to the OpenAI Batch API.
+    """
+    requests = []
+    submitted = {}
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(batch_requests, path, args.questions, args.overwrite): path for path in books}
+        for future in as_completed(futures):
+            try:
+                book_id, hrefs, book_requests = future.result()
+            except Exception as e:
+                print(f'Error for {futures[future]}: {e}')
+                continue
+            requests.extend(book_requests)
+            submitted[futures[future]] = [book_id, hrefs]
+
+    if not requests:
+        print('[INFO] nothing to generate')
+        for path in submitted:  # all chapters have a question bank already
+            save_checkpoint(args.checkpoint, book=path)
+        return
+
+    batch_file = f'logs/batch_input_{int(time.time())}.jsonl'
+    with open(batch_file, 'w') as f:
+        for request in requests:
+            f.write(json.dumps(request) + '\n')
+
+    with open(batch_file, 'rb') as f:
+        input_file = openai.files.create(file=f, purpose='batch')
+    batch = openai.batches.create(input_file_id=input_file.id, endpoint='/v1/chat/completions',
+                                  completion_window='24h')
+
+    # books are only finished once the results are stored with --collect
+    save_checkpoint(args.checkpoint, batch_id=batch.id, books=submitted)
+    print(f'[INFO] submitted {len(requests)} requests as {batch.id}, '
+          f'run with --collect {batch.id} once it is completed')
+
+
+def collect_batch(batch_id, checkpoint):
+    """
+    Download the results of a finished batch, store them as question banks and mark the books as finished whose
+    chapters all got a bank. Books of a failed or expired batch (or with failed requests) are submitted again on the
+    next run.
+    """
+    submissions = [entry for entry in read_checkpoint(checkpoint) if entry.get('batch_id') == batch_id]
+    if not submissions:
+        print(f'Error: batch {batch_id} not found in {checkpoint}')
+        return
+
+    batch = openai.batches.retrieve(batch_id)
+    if batch.status in ('validating', 'in_progress', 'finalizing', 'cancelling'):
+        print(f'[INFO] batch {batch_id} is {batch.status}')
+        return
+
+    # group the quizzes by book and href (expired batches can have results for some of the requests)
+    chapters = {}
+    if batch.output_file_id:
+        for line in openai.files.content(batch.output_file_id).text.splitlines():
+            result = json.loads(line)
+            book_id, href, num_tokens, _ = json.loads(result['custom_id'])
+            quizzes = chapters.setdefault((book_id, href), (num_tokens, []))[1]
+            if result.get('error') or result['response']['status_code'] != 200:
+                print(f'Error for {book_id} {href}: {result.get("error")}')
+                continue
+            try:
+                content = result['response']['body']['choices'][0]['message']['content']
+                quizzes.append(json.loads(fix_busted_json.repair_json(content)))
+            except Exception as e:
+                print(f'Error for {book_id} {href}: {e}')
+
+    for path, (book_id, hrefs) in submissions[-1]['books'].items():
+        missing = []
+        for href, num_parts in hrefs.items():
+            num_tokens, quizzes = chapters.get((book_id, href), (0, []))
+            if len(quizzes) < num_parts:  # only store complete banks (see generate_book)
+                missing.append(href)
+                continue
+            num_stored = store_quizzes(book_id, href, quizzes, num_tokens)
+            print(f'[INFO] {book_id}: {num_stored} questions for {href}')
+            if not num_stored:
+                missing.append(href)
+
+        if missing:
+            print(f'Error for {path}: no question banks for {len(missing)} chapters, will be submitted again')
+        else:
+            save_checkpoint(checkpoint, book=path)
+            print(f'[INFO] finished {path}')
+
+    save_checkpoint(checkpoint, collected=batch_id)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pre-generate question banks for EPUB files.')
+    parser.add_argument('paths', nargs='*', help='EPUB files, directories or manifests (.txt or .json)')
+    parser.add_argument('--workers', type=int, default=4, help='number of worker processes')
+    parser.add_argument('--rpm', type=float, default=60, help='maximum requests per minute (all workers)')
+    parser.add_argument('--questions', type=int, default=8, choices=range(1, 11), metavar='[1-10]',
+                        help='questions per part of a chapter')
+    parser.add_argument('--checkpoint', default='logs/batch_checkpoint.jsonl', help='file with finished books')
+    parser.add_argument('--overwrite', action='store_true', help='regenerate existing question banks')
+    parser.add_argument('--batch-api', action='store_true', help='submit prompts to the OpenAI Batch API')
+    parser.add_argument('--collect', metavar='BATCH_ID', help='store the results of a completed batch')
+    args = parser.parse_args()
+
+    os.makedirs('logs', exist_ok=True)  # prompt_model writes its logs there
+    nltk.download('punkt')  # for sentence tokenization
+
+    if args.collect:
+        collect_batch(args.collect, args.checkpoint)
+        return
+
+    done, pending = load_checkpoint(args.checkpoint)
+    books = [path for path in find_books(args.paths) if path not in done and path not in pending]
+    print(f'[INFO] {len(books)} books to process ({len(done)} already done, {len(pending)} in submitted batches)')
+
+    if args.batch_api:
+        submit_batch(books, args)
+    else:
+        run_books(books, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""
+Benchmark for the compression of cached chapters in chapter_cache.py: compression ratio, encode/decode latency and
+the hit rate of an LRU cache (like Redis with allkeys-lru) with a fixed memory budget.
+Run from the repository root with: python -m api.benchmarks.bench_chapter_cache books/*.epub [--budget-mb 30]
+
+The dictionary is trained on every second chapter and evaluated on the others.
+"""
+import argparse
+import random
+import time
+from collections import OrderedDict
+
+from api.chapter_cache import compress_chapter, decompress_chapter, load_dictionary, train_dictionary
+from api.parse_hrefs import get_content_from_file
+
+KEY_OVERHEAD = 80  # approximate memory of a Redis key (key name, object header, dict entry)
+
+
+def measure(chapters, encode, decode):
+    """
+    Return entry sizes and mean encode/decode time per chapter in ms.
+    """
+    start = time.perf_counter()
+    entries = [encode(chapter) for chapter in chapters]
+    encode_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for entry in entries:
+        decode(entry)
+    decode_time = time.perf_counter() - start
+
+    return [len(entry) for entry in entries], encode_time * 1000 / len(chapters), decode_time * 1000 / len(chapters)
+
+
+def lru_hit_rate(sizes, budget, num_requests=200000, zipf_s=1.0, seed=0):
+    """
+    Simulate an LRU cache with a memory budget and Zipf-distributed requests for the chapters.
+    """
+    rng = random.Random(seed)
+    order = list(range(len(sizes)))
+    rng.shuffle(order)  # popularity does not depend on size
+    weights = [1 / (rank + 1) ** zipf_s for rank in range(len(sizes))]
+
+    cache = OrderedDict()
+    used = 0
+    hits = 0
+    for index in rng.choices(order, weights=weights, k=num_requests):
+        if index in cache:
+            cache.move_to_end(index)
+            hits += 1
+            continue
+        cache[index] = sizes[index] + KEY_OVERHEAD
+        used += cache[index]
+        while used > budget:
+            _, size = cache.popitem(last=False)
+            used -= size
+    return hits / num_requests
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('books', nargs='+')
+    parser.add_argument('--budget-mb', type=float, default=30, help='Redis memory budget (free plan: 30 MB)')
+    args = parser.parse_args()
+
+    chapters = [chapter for path in args.books for chapter in get_content_from_file(None, path)]
+    train, test = chapters[::2], chapters[1::2]
+
+    dict_path = '/tmp/bench_chapter_dict.zstd'
+    with open(dict_path, 'wb') as f:
+        f.write(train_dictionary(train))
+    dictionary = load_dictionary(dict_path)
+
+    raw_size = sum(len(chapter.encode('utf-8')) for chapter in test)
+    print(f'{len(test)} test chapters, {raw_size / 1e6:.1f} MB uncompressed, budget {args.budget_mb} MB\n')
+    print(f'{"":<18}{"ratio":>8}{"encode ms":>12}{"decode ms":>12}{"hit rate":>10}')
+    variants = [('uncompressed', lambda text: text.encode('utf-8'), lambda value: value.decode('utf-8')),
+                ('zstd', lambda text: compress_chapter(text, None), lambda value: decompress_chapter(value, None)),
+                ('zstd + dictionary', lambda text: compress_chapter(text, dictionary),
+                 lambda value: decompress_chapter(value, dictionary))]
+    for name, encode, decode in variants:
+        sizes, encode_ms, decode_ms = measure(test, encode, decode)
+        hit_rate = lru_hit_rate(sizes, args.budget_mb * 1e6)
+        print(f'{name:<18}{raw_size / sum(sizes):>8.2f}{encode_ms:>12.3f}{decode_ms:>12.3f}{hit_rate:>10.1%}')
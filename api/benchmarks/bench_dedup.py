@@ -0,0 +1,69 @@
+"""
+Benchmark for the near-duplicate question detection in question_dedup.py.
+Run from the repository root with: python -m api.benchmarks.bench_dedup
+"""
+import random
+import time
+
+from api.question_dedup import deduplicate_quizzes
+
+WORDS = ('python list dictionary function variable loop index value key error memory class object method '
+         'string integer float module import return argument parameter scope closure generator iterator '
+         'exception file socket thread process queue stack heap tree graph node edge path sort search').split()
+# prefixes and suffixes to get a vocabulary of realistic size (a few thousand words)
+WORDS = [prefix + word + suffix for word in WORDS for prefix in ('', 'sub', 'pre', 'multi', 'meta', 'inter')
+         for suffix in ('', 's', 'ing', 'ed', 'er', 'al', 'ly', 'ness')]
+
+
+def make_question(rng):
+    return {'question': ' '.join(rng.choices(WORDS, k=14)) + '?',
+            'options': {letter: ' '.join(rng.choices(WORDS, k=4)) for letter in 'ABCD'},
+            'correct_answer': ['A']}
+
+
+def rephrase(question, rng):
+    # near-duplicate: swap a single word in the question, keep the options
+    words = question['question'].split()
+    words[rng.randrange(len(words))] = rng.choice(WORDS)
+    return {**question, 'question': ' '.join(words)}
+
+
+def reorder(question, rng):
+    # near-duplicate: same question and options, options in a different order
+    letters = list(question['options'])
+    rng.shuffle(letters)
+    return {**question, 'options': {new: question['options'][old] for new, old in zip('ABCD', letters)},
+            'correct_answer': ['ABCD'[letters.index(question['correct_answer'][0])]]}
+
+
+def same_options(question, rng):
+    # not a duplicate: same options, one word of the question and the correct answer differ
+    # (e.g. "Which statement about lists is true?" and "... about tuples ...")
+    words = question['question'].split()
+    words[rng.randrange(len(words))] = rng.choice(WORDS)
+    return {**question, 'question': ' '.join(words), 'correct_answer': [rng.choice('BCD')]}
+
+
+def make_pool(num_questions, num_parts, duplicate_share, make_duplicate, rng):
+    questions = [make_question(rng) for _ in range(int(num_questions * (1 - duplicate_share)))]
+    questions += [make_duplicate(question, rng) for question in rng.sample(questions, num_questions - len(questions))]
+    rng.shuffle(questions)
+    return [{'questions': questions[i::num_parts]} for i in range(num_parts)]
+
+
+if __name__ == '__main__':
+    rng = random.Random(0)
+    variants = [('duplicates, rephrased', rephrase), ('duplicates, reordered options', reorder),
+                ('same options, other correct answer (should be kept)', same_options)]
+    for name, make_duplicate in variants:
+        print(f'20% {name}:')
+        for num_questions, num_parts in [(50, 5), (200, 15), (1000, 50), (5000, 200)]:
+            timings = []
+            for _ in range(5):
+                quizzes = make_pool(num_questions, num_parts, 0.2, make_duplicate, rng)
+                start = time.perf_counter()
+                remaining, _ = deduplicate_quizzes(quizzes)
+                timings.append(time.perf_counter() - start)
+            kept = sum(len(quiz['questions']) for quiz in remaining)
+            print(f'{num_questions:>5} questions: {min(timings) * 1000:7.1f} ms (best of 5), '
+                  f'{kept} kept, {num_questions - kept} removed')
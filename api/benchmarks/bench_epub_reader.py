@@ -0,0 +1,60 @@
+"""
+Benchmark for the lazy EPUB reader in epub_reader.py: peak memory (RSS) and time to extract a few selected chapters,
+compared with reading the whole book with ebooklib (epub.read_epub) as before.
+Run from the repository root with: python -m api.benchmarks.bench_epub_reader books/*.epub [--chapters 3]
+
+Every measurement runs in a fresh process, so the peak RSS of one run does not affect the others.
+"""
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # ru_maxrss is in KB on Linux
+
+
+def run(reader, path, num_chapters):
+    """
+    Extract the first chapters of a book with one reader and return peak RSS above the baseline and time.
+    """
+    from ebooklib import epub
+    from api.epub_reader import read_epub_lazy
+    from api.parse_hrefs import extract_chapter, get_toc_hrefs, order_selected_hrefs
+
+    baseline = peak_rss_mb()
+    start = time.perf_counter()
+
+    book = epub.read_epub(path) if reader == 'ebooklib' else read_epub_lazy(path)
+    all_hrefs = get_toc_hrefs(book)
+    selected_hrefs = order_selected_hrefs(all_hrefs[:num_chapters], all_hrefs)
+    chapters = [extract_chapter(book, href, all_hrefs) for href in selected_hrefs]
+
+    return {'rss_mb': peak_rss_mb() - baseline, 'seconds': time.perf_counter() - start,
+            'characters': sum(len(chapter or '') for chapter in chapters)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('books', nargs='+')
+    parser.add_argument('--chapters', type=int, default=3, help='number of selected chapters')
+    parser.add_argument('--run', help=argparse.SUPPRESS)  # used for the measurement in a fresh process
+    args = parser.parse_args()
+
+    if args.run:
+        print(json.dumps(run(args.run, args.books[0], args.chapters)))
+        sys.exit()
+
+    print(f'{"book":<30}{"ebooklib MB":>12}{"lazy MB":>10}{"ebooklib s":>12}{"lazy s":>10}')
+    for path in args.books:
+        results = {}
+        for reader in ('ebooklib', 'lazy'):
+            output = subprocess.run([sys.executable, '-m', 'api.benchmarks.bench_epub_reader', path, '--run', reader,
+                                     '--chapters', str(args.chapters)], capture_output=True, text=True, check=True)
+            results[reader] = json.loads(output.stdout.strip().splitlines()[-1])
+        assert results['ebooklib']['characters'] == results['lazy']['characters']
+        print(f'{path[-30:]:<30}{results["ebooklib"]["rss_mb"]:>12.1f}{results["lazy"]["rss_mb"]:>10.1f}'
+              f'{results["ebooklib"]["seconds"]:>12.3f}{results["lazy"]["seconds"]:>10.3f}')
@@ -0,0 +1,87 @@
+"""
+Compression of chapter texts cached in Redis (see parse_hrefs.py). Entries are stored with a small header:
+
+    b'\x00z\x00' + zstd frame                 compressed without dictionary
+    b'\x00z\x01' + zstd frame                 compressed with the trained dictionary (ZSTD_DICT_PATH)
+    anything else                             old uncompressed UTF-8 entry
+
+To train a dictionary for EPUB prose, run from the repository root:
+
+    python -m api.chapter_cache chapter_dict.zstd books/*.epub
+
+and set the environment variable ZSTD_DICT_PATH to the path of the dictionary file.
+"""
+import os
+import sys
+import zstandard
+from dotenv import load_dotenv
+
+load_dotenv()
+
+HEADER = b'\x00z'
+PLAIN = b'\x00'
+WITH_DICT = b'\x01'
+
+COMPRESSION_LEVEL = 6  # good ratio for text while compression stays around 1 ms per chapter
+
+
+def load_dictionary(path):
+    """
+    Load a trained zstd dictionary from a file, or return None if no path is given.
+    """
+    if not path:
+        return None
+    with open(path, 'rb') as f:
+        dictionary = zstandard.ZstdCompressionDict(f.read())
+    dictionary.precompute_compress(level=COMPRESSION_LEVEL)
+    return dictionary
+
+
+dictionary = load_dictionary(os.getenv('ZSTD_DICT_PATH'))
+
+
+def compress_chapter(text, dictionary=dictionary):
+    """
+    Compress the text of a chapter for the cache.
+    """
+    if dictionary is not None:
+        compressor = zstandard.ZstdCompressor(level=COMPRESSION_LEVEL, dict_data=dictionary)
+        return HEADER + WITH_DICT + compressor.compress(text.encode('utf-8'))
+    return HEADER + PLAIN + zstandard.ZstdCompressor(level=COMPRESSION_LEVEL).compress(text.encode('utf-8'))
+
+
+def decompress_chapter(value, dictionary=dictionary):
+    """
+    Get the text of a chapter from a cache entry (compressed or old uncompressed entry). Returns None if the entry
+    cannot be decompressed (e.g. compressed with another dictionary), so that it is treated as a cache miss.
+    """
+    if not value.startswith(HEADER):
+        return value.decode('utf-8')  # uncompressed entry from before
+
+    try:
+        if value[2:3] == WITH_DICT:
+            if dictionary is None:
+                return None
+            return zstandard.ZstdDecompressor(dict_data=dictionary).decompress(value[3:]).decode('utf-8')
+        return zstandard.ZstdDecompressor().decompress(value[3:]).decode('utf-8')
+    except zstandard.ZstdError as e:
+        print(f'Error: {e}')
+        return None
+
+
+def train_dictionary(chapters, dict_size=112640):
+    """
+    Train a zstd dictionary on a list of chapter texts and return it as bytes.
+    """
+    samples = [chapter.encode('utf-8') for chapter in chapters]
+    return zstandard.train_dictionary(dict_size, samples).as_bytes()
+
+
+if __name__ == '__main__':
+    from api.parse_hrefs import get_content_from_file
+
+    output_path, book_paths = sys.argv[1], sys.argv[2:]
+    chapters = [chapter for path in book_paths for chapter in get_content_from_file(None, path)]
+    with open(output_path, 'wb') as f:
+        f.write(train_dictionary(chapters))
+    print(f'[INFO] trained dictionary on {len(chapters)} chapters from {len(book_paths)} books: {output_path}')
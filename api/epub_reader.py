@@ -0,0 +1,86 @@
+import posixpath
+import zipfile
+from urllib.parse import unquote
+from ebooklib import epub
+
+
+class LazyEpubReader(epub.EpubReader):
+    """
+    Lightweight version of ebooklib's reader (epub.read_epub): opens the zip file once and only reads the OPF and the
+    nav/NCX for the TOC. All other members (chapters, images, fonts, ...) are only indexed by name and read when they
+    are requested with get_item_with_href, so memory per request depends on the selected chapters, not on the book.
+    TOC hrefs and item names are the same as with ebooklib.
+    """
+
+    def __init__(self, file_name):
+        super().__init__(file_name)
+        self.members = {}  # item name (relative to OPF, as in ebooklib) -> (name in zip file, media type, id)
+
+    def _load_manifest(self):
+        for r in self.container.find('{%s}manifest' % epub.NAMESPACES['OPF']):
+            if r.tag != '{%s}item' % epub.NAMESPACES['OPF']:
+                continue
+
+            media_type = r.get('media-type')
+            properties = r.get('properties', '').split()
+            name = unquote(r.get('href'))
+
+            # only the items for the TOC are read now
+            if media_type == 'application/x-dtbncx+xml':
+                item = epub.EpubNcx(uid=r.get('id'), file_name=name)
+                item.content = self.read_file(posixpath.join(self.opf_dir, name))
+                self.book.add_item(item)
+            elif media_type == 'application/xhtml+xml' and 'nav' in properties:
+                item = epub.EpubNav(uid=r.get('id'), file_name=name)
+                item.content = self.read_file(posixpath.join(self.opf_dir, r.get('href')))
+                self.book.add_item(item)
+            else:
+                self.members[name] = (posixpath.join(self.opf_dir, name), media_type, r.get('id'))
+
+    def load(self):
+        # unlike ebooklib, the zip file stays open to read chapters later (close it with close())
+        try:
+            self.zf = zipfile.ZipFile(self.file_name, 'r', allowZip64=True)
+        except zipfile.BadZipfile:
+            raise epub.EpubException(0, 'Bad Zip file')
+
+        self._load_container()
+        self._load_opf_file()
+        return self
+
+    @property
+    def toc(self):
+        return self.book.toc
+
+    def get_item_with_href(self, href):
+        """
+        Read one item of the book, same as book.get_item_with_href in ebooklib. Returns None if nothing was found.
+        """
+        item = self.book.get_item_with_href(href)  # nav and ncx are read already
+        if item is not None or href not in self.members:
+            return item
+
+        file_name, media_type, uid = self.members[href]
+        if media_type == 'application/xhtml+xml':
+            item = epub.EpubHtml(uid=uid, file_name=href, media_type=media_type)
+        else:
+            item = epub.EpubItem(uid=uid, file_name=href, media_type=media_type)
+        item.content = self.read_file(file_name)
+        item.book = self.book  # EpubHtml.get_content needs the book (not added to it, so the memory can be freed)
+        return item
+
+    def close(self):
+        self.zf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_epub_lazy(file_name):
+    """
+    Open an EPUB file (path or file-like object) with LazyEpubReader. Use it as context manager to close the file.
+    """
+    return LazyEpubReader(file_name).load()
@@ -1,3 +1,4 @@
+import asyncio
 import os
 import openai
 from dotenv import load_dotenv
@@ -12,6 +13,9 @@ load_dotenv()
 openai.organization = os.getenv('OPENAI_ORG')
 openai.api_key = os.getenv('OPENAI_API_KEY')
 
+# async client for the async app (same key and organization)
+async_openai = openai.AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'), organization=os.getenv('OPENAI_ORG'))
+
 # encoding to count tokens
 enc = tiktoken.encoding_for_model('gpt-3.5-turbo-0125')
 
@@ -19,14 +23,10 @@ enc = tiktoken.encoding_for_model('gpt-3.5-turbo-0125')
 genai.configure(api_key=os.getenv('GAPI'))
 
 
-def prompt_model(text, num_questions=4, options_per_question=4,
-                 difficulty='', model='gpt-3.5-turbo-0125', num_tokens=0, not_valid_max=3, gemini_1_max=30000):
+def get_prompt(text, num_questions=4, options_per_question=4, difficulty=''):
     """
-    Function to generate multiple-choice quizzes with given parameters and text as input. Returns a JSON object with
-    the quiz if successful, "split_parts" if the text is too long for the model, and None if the function fails.
+    Build the prompt to generate a multiple-choice quiz with the given parameters and text as input.
     """
-    valid_output = False
-
     # dictionary for number to word conversion
     number_dict = {1: 'one', 2: 'two', 3: 'three', 4: 'four', 5: 'five', 6: 'six',
                    7: 'seven', 8: 'eight', 9: 'nine', 10: 'ten'}
@@ -226,7 +226,79 @@ Output Template:
     }}
     """
 
-    current_prompt = prompt_4
+    return prompt_4
+
+
+def gemini_model(num_tokens, gemini_1_max=30000):
+    """
+    Choose the gemini model for the number of tokens, returns the model name and its log file.
+    """
+    #  gemini-1.0-pro (up to 30k input window); gemini-1.5-pro-latest up to 1mio currently
+    if num_tokens < gemini_1_max:
+        # max 60 RPM currently, for most recent info check
+        # https://ai.google.dev/gemini-api/docs/models/gemini#model-variations
+        return 'gemini-1.0-pro', 'logs/gemini_completions.txt'
+    # currently a preview model, do not use for production
+    return 'gemini-1.5-pro-latest', 'logs/gemini1.5_completions.txt'  # gemini-1.5-flash would be possible too
+
+
+def parse_gemini_response(response):
+    """
+    Get the quiz as JSON object from a gemini response.
+    """
+    # gemini usually starts json with markdown-like format in the response
+    # ```JSON or ```json which leads to problems with json.loads
+    # json_repair is for repairing any syntax errors that LLMs usually make
+    response_trimmed = response.text.lstrip("```JSON").rstrip("```")
+    response_trimmed = response_trimmed.lstrip("```json")  # since rstrip from previous includes ending `
+
+    return json.loads(fix_busted_json.repair_json(response_trimmed))  # fix json if possible
+
+
+def parse_openai_completion(completion):
+    """
+    Get the quiz as JSON object from an OpenAI chat completion.
+    """
+    # possible that completion has bad json format, so we need to account for that with fix_busted_json
+    return json.loads(fix_busted_json.repair_json(completion.choices[0].message.content))
+
+
+def openai_messages(prompt):
+    """
+    Messages for the OpenAI chat completion in JSON mode.
+    """
+    return [{"role": "system", "content": "You are a helpful assistant designed to output JSON."},  # needed for json output mode
+            {"role": "user", "content": prompt}]
+
+
+def write_log(log_file, entry):
+    """
+    Append an entry to a log file (we could also use a db). In async code, run it with asyncio.to_thread.
+    """
+    with open(log_file, 'a') as f:
+        f.write(f'{entry}\n')
+
+
+def json_output_log(final_completion, prompt, num_questions, options_per_question, model):
+    # log final completion together with "prompt" and "num_questions" and "options_per_question"
+    return json.dumps({
+        "completion": final_completion,
+        "prompt": prompt,
+        "num_questions": num_questions,
+        "options_per_question": options_per_question,
+        "model": model
+    })
+
+
+def prompt_model(text, num_questions=4, options_per_question=4,
+                 difficulty='', model='gpt-3.5-turbo-0125', num_tokens=0, not_valid_max=3, gemini_1_max=30000):
+    """
+    Function to generate multiple-choice quizzes with given parameters and text as input. Returns a JSON object with
+    the quiz if successful, "split_parts" if the text is too long for the model, and None if the function fails.
+    """
+    valid_output = False
+
+    current_prompt = get_prompt(text, num_questions, options_per_question, difficulty)
 
     # token count of prompt
     # print('prompt token count:', len(enc.encode(current_prompt)))
@@ -240,38 +312,17 @@ Output Template:
 
         if model == 'gemini':
             try:
-                #  gemini-1.0-pro (up to 30k input window); gemini-1.5-pro-latest up to 1mio currently
-                if num_tokens < gemini_1_max:
-                    gemini = genai.GenerativeModel('gemini-1.0-pro')
-                    response = gemini.generate_content(current_prompt)
-
-                    print('[INFO] used gemini 1.0')
-                    print('[INFO] prompt token count:', len(enc.encode(current_prompt)))
-
-                    # log in a text file, we could also use a db
-                    with open('logs/gemini_completions.txt', 'a+') as f:
-                        f.write(f'{response}\n')
-                    # max 60 RPM currently, for most recent info check
-                    # https://ai.google.dev/gemini-api/docs/models/gemini#model-variations
-
-                else:
-                    # currently a preview model, do not use for production
-                    gemini = genai.GenerativeModel('gemini-1.5-pro-latest')  # gemini-1.5-flash would be possible too
-                    response = gemini.generate_content(current_prompt)
-
-                    print('[INFO] used gemini 1.5')
-                    print('[INFO] prompt token count:', len(enc.encode(current_prompt)))
-
-                    with open('logs/gemini1.5_completions.txt', 'a+') as f:
-                        f.write(f'{response}\n')
-
-                # gemini usually starts json with markdown-like format in the response
-                # ```JSON or ```json which leads to problems with json.loads
-                # json_repair is for repairing any syntax errors that LLMs usually make
-                response_trimmed = response.text.lstrip("```JSON").rstrip("```")
-                response_trimmed = response_trimmed.lstrip("```json")  # since rstrip from previous includes ending `
-
-                final_completion = json.loads(fix_busted_json.repair_json(response_trimmed))  # fix json if possible
+                model_name, log_file = gemini_model(num_tokens, gemini_1_max)
+                gemini = genai.GenerativeModel(model_name)
+                response = gemini.generate_content(current_prompt)
+
+                print(f'[INFO] used {model_name}')
+                print('[INFO] prompt token count:', len(enc.encode(current_prompt)))
+
+                # log in a text file
+                write_log(log_file, response)
+
+                final_completion = parse_gemini_response(response)
                 valid_output = True
 
             except Exception as e:
@@ -290,27 +341,15 @@ Output Template:
                 completion = openai.chat.completions.create(model=model,
                                                             # temperature=0.6,  # if you want to adjust temperature
                                                             response_format={"type": "json_object"},
-                                                            messages=[{"role": "system",
-                                                                       "content": "You are a helpful assistant designed to output JSON."},  # needed for json output mode
-                                                                      {"role": "user", "content": current_prompt}])
+                                                            messages=openai_messages(current_prompt))
 
-                with open('logs/chatgpt_completions.txt', 'a') as f:
-                    f.write(f'{completion}\n')
+                write_log('logs/chatgpt_completions.txt', completion)
 
                 # if it is valid json, we can break the loop
-                # possible that completion has bad json format, so we need to account for that with fix_busted_json
-                final_completion = json.loads(fix_busted_json.repair_json(completion.choices[0].message.content))
-
-                with open('logs/json_outputs.txt', 'a') as f:
-                    # log final completion together with "prompt" and "num_questions" and "options_per_question"
-                    log_data = {
-                        "completion": final_completion,
-                        "prompt": current_prompt,
-                        "num_questions": num_questions,
-                        "options_per_question": options_per_question,
-                        "model": model
-                    }
-                    f.write(f'{json.dumps(log_data)}\n')
+                final_completion = parse_openai_completion(completion)
+
+                write_log('logs/json_outputs.txt', json_output_log(final_completion, current_prompt, num_questions,
+                                                                   options_per_question, model))
 
                 valid_output = True
             except Exception as e:
@@ -319,3 +358,53 @@ Output Template:
                 print('Trying again...')
 
     return final_completion  # returns questions in json format according to prompt
+
+
+async def prompt_model_async(text, num_questions=4, options_per_question=4,
+                             difficulty='', model='gpt-3.5-turbo-0125', num_tokens=0, not_valid_max=3,
+                             gemini_1_max=30000):
+    """
+    Async version of prompt_model with the async OpenAI and Gemini clients, so that waiting for the model does not
+    block the server. Same parameters and return values as prompt_model.
+    """
+    current_prompt = get_prompt(text, num_questions, options_per_question, difficulty)
+
+    for not_valid_counter in range(1, not_valid_max + 1):
+        if model == 'gemini':
+            try:
+                model_name, log_file = gemini_model(num_tokens, gemini_1_max)
+                gemini = genai.GenerativeModel(model_name)
+                response = await gemini.generate_content_async(current_prompt)
+
+                print(f'[INFO] used {model_name}')
+                await asyncio.to_thread(write_log, log_file, response)  # file writes would block the event loop
+
+                return parse_gemini_response(response)
+
+            except Exception as e:
+                print(f'Error: {e}')
+                print('Trying again...')
+                if not_valid_counter == not_valid_max:
+                    return 'split_parts'
+
+        else:  # gpt-3 model with 16k token context
+            try:
+                completion = await async_openai.chat.completions.create(model=model,
+                                                                        response_format={"type": "json_object"},
+                                                                        messages=openai_messages(current_prompt))
+
+                await asyncio.to_thread(write_log, 'logs/chatgpt_completions.txt', completion)
+
+                final_completion = parse_openai_completion(completion)
+
+                await asyncio.to_thread(write_log, 'logs/json_outputs.txt',
+                                        json_output_log(final_completion, current_prompt, num_questions,
+                                                        options_per_question, model))
+
+                return final_completion
+            except Exception as e:
+                print(f'Error: {e}')
+                print('Trying again...')
+
+    print('[INFO] too many attempts')  # for runtime logs
+    return None  # front end will show "oops..." message to user in case of no quiz
@@ -1,46 +1,38 @@
-import urllib.request
+import asyncio
+import json
+import tempfile
 from ebooklib import epub
 import re
 from bs4 import BeautifulSoup
+import httpx
 import redis
+import redis.asyncio
 import os
 from dotenv import load_dotenv
 
+from api.chapter_cache import compress_chapter, decompress_chapter
+from api.epub_reader import read_epub_lazy
+
 load_dotenv()
 
-# cache for text content of chapters
+# redis with sync client, for the question banks of batch_generate.py (see quiz_cache.py)
 r = redis.Redis(
     host=os.getenv('REDIS_HOST'),
     port=10618,
     password=os.getenv('REDIS_PW'))
 
+# cache for text content of chapters (and question banks), with async client for the async app
+ar = redis.asyncio.Redis(
+    host=os.getenv('REDIS_HOST'),
+    port=10618,
+    password=os.getenv('REDIS_PW'))
+
 
-def get_content(selected_hrefs, url):
+def get_toc_hrefs(book):
     """
-    Given a list of hrefs and an url, get content of the selected chapters from an EPUB file as a list of strings.
+    Get all hrefs of an EPUB book (read with ebooklib or read_epub_lazy) in the order they appear in the TOC.
     """
 
-    # depending on whether a temp file is in there already, we have to use another name (in case of multiple users)
-    temp_file_name = 'temporary_save.epub'
-
-    for i in range(100):  # while loop would be possible too but im limiting it to 100 epubs at once
-        if os.path.exists(temp_file_name):
-            temp_file_name = f'temporary_save{i}.epub'
-        else:
-            break
-
-    # keep trying to download file until it works (sometimes it fails due to ContentTooShortError)
-    while True:
-        try:
-            urllib.request.urlretrieve(url, temp_file_name)
-            break
-        except Exception as e:
-            print(f'Error: {e}')
-            print('Trying again...')
-
-    # parse the epub file
-    book = epub.read_epub(temp_file_name)
-
     # get all hrefs in the order they appear in the TOC
     def extract_hrefs(item):
         # if item is a tuple, it represents a section with its own items
@@ -63,6 +55,13 @@ def get_content(selected_hrefs, url):
     for item in book.toc:
         all_hrefs.extend(extract_hrefs(item))
 
+    return all_hrefs
+
+
+def order_selected_hrefs(selected_hrefs, all_hrefs):
+    """
+    Sort the selected hrefs in the order they appear in the TOC and remove children whose parent is selected too.
+    """
     # sort selected hrefs in the order they appear in the TOC
     hrefs_in_order = []
     for href in all_hrefs:
@@ -72,8 +71,6 @@ def get_content(selected_hrefs, url):
     selected_hrefs = hrefs_in_order
     print('selected hrefs', selected_hrefs)
 
-    # get the content of the selected hrefs
-    selected_chapters = []
     # if both parent and child are in the list, we should take the parent
     # (otherwise we would get double content, as child is part of the parent)
     new_href_list = selected_hrefs.copy()  # to prevent changing the list while iterating
@@ -86,71 +83,160 @@ def get_content(selected_hrefs, url):
     selected_hrefs = new_href_list
     print('selected hrefs', selected_hrefs)
 
-    for href in selected_hrefs:
-        print('current href', href)
-        # try to get the content from Redis
-        key = f'{url}:{href}'
-        chapter_content = r.get(key)
-
-        if chapter_content is not None:
-            # if content was found in cache, decode it from bytes to string
-            chapter_content = chapter_content.decode('utf-8')
-            print(f'cache hit for {key}')
-        else:
-            print(f'cache missing for {key}')
-
-            # if href has #, then it is not a separate chapter file, but a part of a chapter
-            if '#' in href:
-                chapter = href.split('#')[0]
-                anchor = href.split('#')[1]
-                next_anchor = None
-
-                # find next href in all_hrefs that has the same base chapter
-                for next_href in all_hrefs[all_hrefs.index(href) + 1:]:
-                    if next_href.startswith(chapter + '#'):
-                        next_anchor = next_href.split('#')[1]
+    return selected_hrefs
+
+
+def extract_chapter(book, href, all_hrefs):
+    """
+    Get the text content of one href of an EPUB book (read with ebooklib or read_epub_lazy), with HREF markers.
+    Returns None if the href is not found in the book.
+    """
+    chapter_content = None
+
+    # if href has #, then it is not a separate chapter file, but a part of a chapter
+    if '#' in href:
+        chapter = href.split('#')[0]
+        anchor = href.split('#')[1]
+        next_anchor = None
+
+        # find next href in all_hrefs that has the same base chapter
+        for next_href in all_hrefs[all_hrefs.index(href) + 1:]:
+            if next_href.startswith(chapter + '#'):
+                next_anchor = next_href.split('#')[1]
+                break
+
+        item = book.get_item_with_href(chapter)  # reads only this chapter
+        if item is not None:
+            content = item.get_body_content().decode('utf-8')
+            fragment_content = []
+            fragment_passed = False  # whether the anchor fragment was observed already
+
+            for line in content.split("\n"):
+                # we need to look for a point to stop if we found the id fragment already
+                if fragment_passed:
+                    # if we find a line starting with the next anchor we stop
+                    if next_anchor and re.findall(f'.+id="{next_anchor}".+', line):
                         break
+                    else:
+                        fragment_content.append(line)
+
+                else:
+                    # find line with anchor fragment
+                    pattern_current_id = f'.+id="{anchor}".+'
+                    if re.findall(pattern_current_id,
+                                  line):  # if no match, re.findall returns [] which is not True
+                        fragment_content.append(line)
+                        fragment_passed = True
+
+            chapter_content = BeautifulSoup('\n'.join(fragment_content),
+                                            'html.parser').get_text()  # parse html to get text only
+            # chapter_content = ''.join(fragment_content)  # if we want to keep html tags instead
+            chapter_content = f'\n\n[HREF START:\t{href}\t]' + '\n' + chapter_content + '\n' + f'[HREF END:\t{href}\t]'
+    else:  # if we are looking for a chapter that is a separate file already
+        item = book.get_item_with_href(href)  # reads only this chapter
+        if item is not None:
+            content = item.get_content().decode('utf-8')
+            chapter_content = BeautifulSoup(content,
+                                            'html.parser').get_text()  # parse html to get text only
+            # chapter_content = ''.join(content)  # if we want to keep html tags
+            chapter_content = f'\n\n[HREF START:\t{href}\t]' + '\n' + chapter_content + '\n' + f'[HREF END:\t{href}\t]'
+
+    return chapter_content
+
+
+def toc_key(url):
+    return f'{url}:__toc__'
+
+
+def get_content_from_file(selected_hrefs, file_name):
+    """
+    Given a list of hrefs (or None for all hrefs in the TOC) and a local EPUB file, get content of the selected
+    chapters as a list of strings (without cache, e.g. for batch_generate.py).
+    """
+    # open the epub file, only the TOC is read until we extract a chapter
+    with read_epub_lazy(file_name) as book:
+        all_hrefs = get_toc_hrefs(book)
+        if selected_hrefs is None:
+            selected_hrefs = all_hrefs
+        selected_hrefs = order_selected_hrefs(selected_hrefs, all_hrefs)
+
+        # get the content of the selected hrefs
+        selected_chapters = []
+        for href in selected_hrefs:
+            chapter_content = extract_chapter(book, href, all_hrefs)
+            if chapter_content is not None:
+                selected_chapters.append(chapter_content)
+
+        return selected_chapters
+
+
+def extract_chapters(file_name, selected_hrefs, cached_hrefs=()):
+    """
+    Parse a local EPUB file and get the TOC hrefs and the content of the selected hrefs that are not cached yet.
+    Does not use Redis, so it can run in a process pool (see get_content_async).
+    """
+    with read_epub_lazy(file_name) as book:
+        all_hrefs = get_toc_hrefs(book)
+        chapters = {href: extract_chapter(book, href, all_hrefs)
+                    for href in order_selected_hrefs(selected_hrefs, all_hrefs) if href not in cached_hrefs}
+    return all_hrefs, chapters
 
-                for item in book.get_items():
-                    if item.get_name() == chapter:
-                        content = item.get_body_content().decode('utf-8')
-                        fragment_content = []
-                        fragment_passed = False  # whether the anchor fragment was observed already
-
-                        for line in content.split("\n"):
-                            # we need to look for a point to stop if we found the id fragment already
-                            if fragment_passed:
-                                # if we find a line starting with the next anchor we stop
-                                if next_anchor and re.findall(f'.+id="{next_anchor}".+', line):
-                                    break
-                                else:
-                                    fragment_content.append(line)
-
-                            else:
-                                # find line with anchor fragment
-                                pattern_current_id = f'.+id="{anchor}".+'
-                                if re.findall(pattern_current_id,
-                                              line):  # if no match, re.findall returns [] which is not True
-                                    fragment_content.append(line)
-                                    fragment_passed = True
-
-                        chapter_content = BeautifulSoup('\n'.join(fragment_content),
-                                                        'html.parser').get_text()  # parse html to get text only
-                        # chapter_content = ''.join(fragment_content)  # if we want to keep html tags instead
-                        chapter_content = f'\n\n[HREF START:\t{href}\t]' + '\n' + chapter_content + '\n' + f'[HREF END:\t{href}\t]'
-            else:  # if we are looking for a chapter that is a separate file already
-                for item in book.get_items():
-                    if item.get_name() == href:
-                        content = item.get_content().decode('utf-8')
-                        chapter_content = BeautifulSoup(content,
-                                                        'html.parser').get_text()  # parse html to get text only
-                        # chapter_content = ''.join(content)  # if we want to keep html tags
-                        chapter_content = f'\n\n[HREF START:\t{href}\t]' + '\n' + chapter_content + '\n' + f'[HREF END:\t{href}\t]'
-            r.set(key, chapter_content)
-
-        selected_chapters.append(chapter_content)
-
-    # delete temporary file
-    os.remove(temp_file_name)
-
-    return selected_chapters  # list with text of the selected hrefs
+
+async def download(url, attempts=5):
+    """
+    Download a file asynchronously into a temporary file (streamed, so the book is never completely in memory) and
+    return its path. The caller has to remove the file.
+    """
+    async with httpx.AsyncClient(timeout=60) as client:
+        for attempt in range(attempts):
+            f = tempfile.NamedTemporaryFile(suffix='.epub', delete=False)
+            try:
+                with f:
+                    async with client.stream('GET', url) as response:
+                        response.raise_for_status()
+                        async for chunk in response.aiter_bytes(1024 * 1024):
+                            f.write(chunk)
+                return f.name
+            except Exception as e:
+                os.remove(f.name)
+                print(f'Error: {e}')
+                if attempt == attempts - 1:
+                    raise
+                print('Trying again...')
+
+
+async def get_content_async(selected_hrefs, url, executor=None):
+    """
+    Given a list of hrefs and an url, get content of the selected chapters from an EPUB file as a list of strings.
+    Uses async Redis and HTTP, and parses the EPUB file in the given executor (e.g. a process pool) so that the event
+    loop is not blocked. If the TOC and all selected chapters are cached, the file
+    is not downloaded at all.
+    """
+    toc = await ar.get(toc_key(url))
+    cached = {}
+    if toc is not None:
+        hrefs = order_selected_hrefs(selected_hrefs, json.loads(toc))
+        values = await ar.mget([f'{url}:{href}' for href in hrefs]) if hrefs else []
+        cached = {href: decompress_chapter(value) for href, value in zip(hrefs, values) if value is not None}
+        cached = {href: content for href, content in cached.items() if content is not None}
+        if len(cached) == len(hrefs):
+            print(f'cache hit for all {len(hrefs)} hrefs of {url}')
+            return [cached[href] for href in hrefs]
+
+    file_name = await download(url)
+    try:
+        loop = asyncio.get_running_loop()
+        all_hrefs, chapters = await loop.run_in_executor(executor, extract_chapters, file_name, selected_hrefs,
+                                                         set(cached))
+    finally:
+        os.remove(file_name)
+
+    # cache TOC and new chapters
+    new_chapters = {f'{url}:{href}': compress_chapter(content) for href, content in chapters.items()
+                    if content is not None}
+    new_chapters[toc_key(url)] = json.dumps(all_hrefs)
+    await ar.mset(new_chapters)
+
+    chapters.update(cached)
+    return [chapters[href] for href in order_selected_hrefs(selected_hrefs, all_hrefs)
+            if chapters.get(href) is not None]
@@ -0,0 +1,235 @@
+import re
+import numpy as np
+import tiktoken
+from nltk.tokenize import sent_tokenize
+
+# encoding to count tokens
+enc = tiktoken.encoding_for_model('gpt-3.5-turbo-0125')
+
+# same markers as in parse_hrefs.py
+HREF_PATTERN = r'\[HREF START:\t([^\t\n]+)\t\](.*?)\[HREF END:\t\1\t\]'
+
+
+def split_passages(content, min_words=40, max_words=250):
+    """
+    Split the chapters (with HREF markers, as returned by get_content_async) into passages of roughly paragraph size.
+    Returns a list of (href, passage) tuples in the order of the text.
+    """
+    passages = []
+    for chapter in content:
+        for href, text in re.findall(HREF_PATTERN, chapter, flags=re.DOTALL):
+            current = []
+            current_words = 0
+            for paragraph in text.split('\n'):
+                paragraph = paragraph.strip()
+                if not paragraph:
+                    continue
+
+                # very long paragraphs are split into sentences so that passages do not get too big
+                for sentence in (sent_tokenize(paragraph) if len(paragraph.split()) > max_words else [paragraph]):
+                    current.append(sentence)
+                    current_words += len(sentence.split())
+                    # short paragraphs (headings, list items) are merged with the following ones
+                    if current_words >= min_words:
+                        passages.append((href, ' '.join(current)))
+                        current = []
+                        current_words = 0
+
+            if current:  # if there's still something left
+                passages.append((href, ' '.join(current)))
+    return passages
+
+
+def salience_scores(passages):
+    """
+    Score passages by how central they are to the whole selection: cosine similarity between the TF-IDF vector of
+    each passage and the centroid of all passages. Vectorized with sparse (passage, term) arrays, so we never build
+    a dense passage x vocabulary matrix. (Used instead of TextRank, which needs a dense passage x passage matrix.)
+    The centroid favours the dominant topic of the selection, so select_passages reserves a share per href.
+    """
+    vocabulary = {}
+    tokens = [[vocabulary.setdefault(word, len(vocabulary)) for word in re.findall(r'[a-z]{3,}', passage.lower())]
+              for passage in passages]
+    lengths = np.array([len(t) for t in tokens])
+    if lengths.sum() == 0:
+        return np.zeros(len(passages))
+
+    # term frequency for each (passage, term) pair
+    passage_ids = np.repeat(np.arange(len(passages)), lengths)
+    term_ids = np.fromiter((i for t in tokens for i in t), dtype=np.int64, count=int(lengths.sum()))
+    pairs, tf = np.unique(passage_ids * len(vocabulary) + term_ids, return_counts=True)
+    passage_ids, term_ids = np.divmod(pairs, len(vocabulary))
+
+    # sublinear tf and smoothed idf, normalized per passage
+    df = np.bincount(term_ids, minlength=len(vocabulary))
+    idf = np.log((len(passages) + 1) / (df + 1)) + 1
+    weights = (1 + np.log(tf)) * idf[term_ids]
+    norms = np.sqrt(np.bincount(passage_ids, weights ** 2, minlength=len(passages)))
+    weights /= norms[passage_ids]
+
+    # centroid of all passages, then dot product of each passage with the normalized centroid
+    centroid = np.bincount(term_ids, weights, minlength=len(vocabulary))
+    centroid /= np.linalg.norm(centroid)
+    return np.bincount(passage_ids, weights * centroid[term_ids], minlength=len(passages))
+
+
+def select_passages(content, token_budget, coverage_share=0.5, min_words=40, max_words=250):
+    """
+    Given the chapters of a selection (with HREF markers) and a token budget, return the most informative passages
+    that fit into the budget as a list of strings (one per href, in the original order, with HREF markers), so it
+    can be used in place of the content from get_content_async.
+
+    coverage_share of the budget is filled round-robin over the hrefs (best remaining passage of each href per round),
+    so that every chapter of the selection is covered, even if it is about another topic than most of the selection.
+    The rest of the budget goes to the passages with the highest scores.
+    """
+    passages = split_passages(content, min_words, max_words)
+    if not passages:
+        return content
+
+    scores = salience_scores([passage for _, passage in passages])
+    counts = np.array([len(enc.encode(passage)) for _, passage in passages])
+
+    # markers of every href cost some tokens too, so keep a small buffer per href
+    marker_tokens = 2 * len(enc.encode('[HREF START:\t\t]')) + 5
+
+    selected = np.zeros(len(passages), dtype=bool)
+    used_hrefs = set()
+    total = 0
+
+    def add(index, budget):  # select a passage if it fits into the budget (passages that are too long are skipped)
+        nonlocal total
+        href = passages[index][0]
+        cost = counts[index] + (marker_tokens if href not in used_hrefs else 0)
+        if total + cost > budget:
+            return
+        selected[index] = True
+        used_hrefs.add(href)
+        total += cost
+
+    # passages of each href, best first (hrefs in the order of the text)
+    ranking = np.argsort(-scores, kind='stable')
+    by_href = {}
+    for index in ranking:
+        by_href.setdefault(passages[index][0], []).append(index)
+
+    # round-robin: every round takes the next best passage of each href, better passages first
+    queues = list(by_href.values())
+    for round_index in range(max(len(queue) for queue in queues)):
+        candidates = [queue[round_index] for queue in queues if round_index < len(queue)]
+        for index in sorted(candidates, key=lambda i: -scores[i]):
+            add(index, token_budget * coverage_share)
+
+    # pack the passages with the highest scores until the budget is reached
+    for index in ranking:
+        if not selected[index]:
+            add(index, token_budget)
+
+    # put the selected passages back together in the order of the text, with the markers of their href
+    selected_chapters = []
+    current_href = None
+    current_passages = []
+    for index in np.flatnonzero(selected):
+        href, passage = passages[index]
+        if href != current_href and current_passages:
+            selected_chapters.append(f'\n\n[HREF START:\t{current_href}\t]' + '\n' + '\n'.join(current_passages) +
+                                     '\n' + f'[HREF END:\t{current_href}\t]')
+            current_passages = []
+        current_href = href
+        current_passages.append(passage)
+
+    if current_passages:
+        selected_chapters.append(f'\n\n[HREF START:\t{current_href}\t]' + '\n' + '\n'.join(current_passages) +
+                                 '\n' + f'[HREF END:\t{current_href}\t]')
+
+    print(f'[INFO] selected {selected.sum()} of {len(passages)} passages ({total} of {counts.sum()} tokens)')
+    return selected_chapters
+
+
+def token_counts(parts):
+    """
+    Count the tokens of each part (runs in the process pool of the app, so that the event loop stays free).
+    """
+    return [len(enc.encode(part)) for part in parts]
+
+
+def split_parts(content, token_limit):
+    """
+    Split the chapters of a selection (with HREF markers) into parts under the token limit for the split_parts
+    approach in app.py: chapters are concatenated while they fit, and chapters above the limit are split into
+    sentences. Runs in the process pool of the app, since tokenizing large selections takes a while.
+    """
+    # calculate tokens in each content part
+    content_counts = token_counts(content)
+
+    # split content into parts under token limit
+    content_parts = []
+    current_part = ''
+    current_count = 0
+    for i, part in enumerate(
+            content):  # content_counts[i] is token count for chapter currently being processed
+
+        if current_count + content_counts[i] > token_limit:  # if adding next chapter would be > limit
+
+            if current_part:  # if current part is not empty, add it to the list
+                # add the parts concatenated up until the current chapter (not included)
+                content_parts.append(current_part)
+            current_part = ''
+            current_count = 0
+
+            # if one chapter alone is already above limit, split into smaller parts
+            # logic could be improved, but for now we split into sentences
+            if content_counts[i] > token_limit:
+                # remove [HREF START:\t.+\t] and [HREF END:\t.+\t] from the part
+                start_pattern = r'\[HREF START:\t.+\t\]'
+                end_pattern = r'\[HREF END:\t.+\t\]'
+
+                # get href of the chapter, save for later
+                href = re.search(r'\[HREF START:\t(.+)\t\]', part).group(1)
+
+                # remove href start and end
+                part = re.sub(start_pattern, '', part)
+                part = re.sub(end_pattern, '', part)
+
+                # tokenize into sentences
+                sentences = sent_tokenize(part)
+                current_part = ""
+                current_token_count = 0
+
+                # create smaller parts under token limit
+                for sentence in sentences:
+                    sentence_token_count = len(enc.encode(sentence))
+
+                    # add as long as we are under token limit
+                    if current_token_count + sentence_token_count < token_limit:
+                        current_part += sentence + " "
+                        current_token_count += sentence_token_count
+                    else:
+                        # add to final list (include hrefs), unless a single sentence is above the limit
+                        if current_part:
+                            current_part = f'[HREF START:\t{href}\t]\n' + current_part + f'\n[HREF END:\t{href}\t]'
+                            content_parts.append(current_part.strip())
+                        current_part = sentence + " "
+                        current_token_count = sentence_token_count
+
+                if current_part.strip():  # if there's still something left
+                    current_part = f'[HREF START:\t{href}\t]\n' + current_part + f'\n[HREF END:\t{href}\t]'
+                    content_parts.append(current_part.strip())
+
+                # the next part starts empty (the last sentences were added above)
+                current_part = ''
+                current_count = 0
+                continue
+
+            # the chapter fits into a part of its own, so it starts the next part
+            current_part = part
+            current_count = content_counts[i]
+
+        else:  # if adding next chapter would be <= limit
+            current_part += part
+            current_count += content_counts[i]
+
+    if current_part:
+        content_parts.append(current_part)  # add the last part
+
+    return content_parts
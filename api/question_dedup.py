@@ -0,0 +1,191 @@
+import re
+import numpy as np
+
+# parameters for minhash signatures and locality-sensitive hashing (bands * rows = number of hash functions)
+NUM_PERM = 64
+NUM_BANDS = 16
+ROWS_PER_BAND = NUM_PERM // NUM_BANDS
+
+# prime above 2**32 for universal hashing (a * x + b) % p, products stay below 2**63
+PRIME = np.uint64(4294967311)
+
+# fixed seed so that the same pool of questions is always deduplicated the same way
+_rng = np.random.default_rng(42)
+_A = _rng.integers(1, 2 ** 31, size=NUM_PERM, dtype=np.uint64)
+_B = _rng.integers(0, 2 ** 31, size=NUM_PERM, dtype=np.uint64)
+
+# hash value used for empty questions (no shingles), so they never collide with real ones
+_EMPTY = np.iinfo(np.uint64).max
+
+
+def question_fields(question):
+    """
+    Get the fields of a question item that are compared for duplicates: the question followed by the answer options
+    in sorted order, so that the same question with reordered options has the same fields.
+    """
+    options = question.get('options') or {}
+    if isinstance(options, dict):
+        options = options.values()
+    return [str(question.get('question', ''))] + sorted(str(option) for option in options)
+
+
+def correct_answer(question):
+    """
+    Get the text of the correct option(s) of a question item, so that it does not depend on the order of the options.
+    """
+    options = question.get('options') or {}
+    letters = question.get('correct_answer') or []
+    if not isinstance(options, dict) or not isinstance(letters, list):
+        return ''
+    return '\n'.join(sorted(str(options.get(letter, '')).strip().lower() for letter in letters))
+
+
+def shingles(texts):
+    """
+    Given a list of texts, each a list of fields (e.g. question and options), return the lowercase word unigrams and
+    bigrams of all texts as one flat array of integer ids, together with the number of shingles of each text (texts
+    are stored one after another in the flat array). Bigrams never cross the boundary between two fields.
+    """
+    vocabulary = {}
+    field_text = np.repeat(np.arange(len(texts)), [len(fields) for fields in texts])  # text index of each field
+    tokens = [[vocabulary.setdefault(word, len(vocabulary)) for word in re.findall(r'\w+', field.lower())]
+              for fields in texts for field in fields]
+    field_lengths = np.array([len(t) for t in tokens], dtype=np.intp)
+    ids = np.fromiter((i for t in tokens for i in t), dtype=np.uint64, count=int(field_lengths.sum()))
+
+    # bigram of two consecutive words in the same field, unigram ids are below len(vocabulary)
+    size = np.uint64(len(vocabulary))
+    last = np.cumsum(field_lengths) - 1
+    is_bigram = np.ones(len(ids), dtype=bool)
+    is_bigram[last[field_lengths > 0]] = False  # last word of a field has no bigram
+    bigrams = size + ids[:-1][is_bigram[:-1]] * size + ids[1:][is_bigram[:-1]]
+
+    # per text: all unigrams followed by all bigrams, so sort by text index to keep them contiguous
+    text_index = np.repeat(field_text, field_lengths)
+    order = np.argsort(np.concatenate((text_index, text_index[:-1][is_bigram[:-1]])), kind='stable')
+    flat = np.concatenate((ids, bigrams))[order]
+    unigram_counts = np.bincount(text_index, minlength=len(texts))
+    bigram_counts = np.bincount(field_text, weights=np.maximum(field_lengths - 1, 0), minlength=len(texts))
+    return flat, unigram_counts + bigram_counts.astype(np.intp)
+
+
+def minhash_signatures(texts):
+    """
+    Compute minhash signatures for a list of texts (each a list of fields). Returns an array of shape (len(texts), NUM_PERM).
+    """
+    flat, lengths = shingles(texts)
+
+    signatures = np.full((len(texts), NUM_PERM), _EMPTY, dtype=np.uint64)
+    non_empty = np.flatnonzero(lengths)
+    if len(non_empty) == 0:
+        return signatures
+
+    # hash all shingles with all permutations at once
+    permuted = (_A[:, None] * (flat[None, :] % PRIME) + _B[:, None]) % PRIME  # shape (NUM_PERM, total shingles)
+
+    # minimum per text (reduceat works on the start offsets of each text in the flat array)
+    offsets = np.concatenate(([0], np.cumsum(lengths[non_empty])[:-1]))
+    signatures[non_empty] = np.minimum.reduceat(permuted, offsets, axis=1).T
+    return signatures
+
+
+def candidate_pairs(signatures):
+    """
+    Find pairs of texts that share at least one band of their minhash signatures (LSH). Returns an array of
+    shape (num_pairs, 2) with i < j.
+    """
+    # combine the rows of each band into a single key, shape (num_texts, NUM_BANDS)
+    bands = signatures.reshape(len(signatures), NUM_BANDS, ROWS_PER_BAND)
+    keys = (bands * _A[:ROWS_PER_BAND]).sum(axis=2)  # wraps around on overflow, which is fine for a key
+
+    # sort (band, key) so that texts in the same bucket are next to each other
+    band_ids = np.broadcast_to(np.arange(NUM_BANDS), keys.shape).ravel()
+    keys = keys.ravel()
+    text_ids = np.repeat(np.arange(len(signatures)), NUM_BANDS)
+    order = np.lexsort((text_ids, keys, band_ids))
+    band_ids, keys, text_ids = band_ids[order], keys[order], text_ids[order]
+
+    # compare each entry with the entries up to `offset` positions after it, until no bucket is that large
+    pairs = []
+    offset = 1
+    while offset < len(keys):
+        same = (keys[:-offset] == keys[offset:]) & (band_ids[:-offset] == band_ids[offset:])
+        if not same.any():
+            break
+        pairs.append(np.stack((text_ids[:-offset][same], text_ids[offset:][same]), axis=1))
+        offset += 1
+
+    if not pairs:
+        return np.empty((0, 2), dtype=np.intp)
+    return np.unique(np.concatenate(pairs), axis=0)
+
+
+def find_duplicates(texts, threshold=0.6, answers=None):
+    """
+    Given a list of texts (each a list of fields, the first one is the question), find the indices that are
+    near-duplicates of an earlier text, i.e. their estimated Jaccard similarity (of word unigrams and bigrams) is at
+    least the threshold, for all fields and for the question alone (so that shared options do not outweigh a different
+    question). If answers are given (e.g. the correct option of each question), texts with different answers are never
+    duplicates. The first occurrence is always kept. Returns a dict with the index of each duplicate and its highest
+    similarity to a kept text.
+    """
+    if len(texts) < 2:
+        return {}
+
+    signatures = minhash_signatures(texts)
+    pairs = candidate_pairs(signatures)
+    if len(pairs) == 0:
+        return {}
+
+    # estimated jaccard similarity is the fraction of equal minhash values, computed for all pairs at once
+    similarity = (signatures[pairs[:, 0]] == signatures[pairs[:, 1]]).mean(axis=1)
+    is_similar = (similarity >= threshold) & (signatures[pairs[:, 0], 0] != _EMPTY)
+    similar, similarity = pairs[is_similar], similarity[is_similar]
+    if len(similar) == 0:
+        return {}
+
+    # the question alone has to be similar too (signatures only for the texts of similar pairs)
+    texts_of_pairs, positions = np.unique(similar, return_inverse=True)
+    question_signatures = minhash_signatures([texts[i][:1] for i in texts_of_pairs])
+    positions = positions.reshape(similar.shape)
+    question_similarity = (question_signatures[positions[:, 0]] == question_signatures[positions[:, 1]]).mean(axis=1)
+    is_similar = question_similarity >= threshold
+
+    if answers is not None:  # only compared if both answers are known
+        is_similar &= np.array([not answers[i] or not answers[j] or answers[i] == answers[j] for i, j in similar],
+                               dtype=bool)
+    similar, similarity = similar[is_similar], similarity[is_similar]
+
+    # walk through the similar pairs in order and drop the later question if the earlier one is kept
+    duplicates = {}
+    for k in np.lexsort((similar[:, 1], similar[:, 0])):
+        i, j = int(similar[k, 0]), int(similar[k, 1])
+        if i not in duplicates:
+            duplicates[j] = max(duplicates.get(j, 0.0), float(similarity[k]))
+    return duplicates
+
+
+def deduplicate_quizzes(quizzes, threshold=0.6):
+    """
+    Remove near-duplicate questions across a list of quizzes (e.g. one quiz per content part), so that overlapping
+    content does not lead to the same question twice. Quizzes are changed in place, empty quizzes are removed.
+    Returns the list of remaining quizzes and the removed questions, least similar to a kept question first (to fill
+    up a quiz if not enough questions are left).
+    """
+    quizzes = [quiz for quiz in quizzes if quiz and quiz.get('questions')]  # prompt_model can return None
+
+    # flat list of (quiz index, question) so that we can compare questions from all quizzes at once
+    items = [(q, question) for q, quiz in enumerate(quizzes) for question in quiz['questions']]
+    duplicates = find_duplicates([question_fields(question) for _, question in items], threshold,
+                                 [correct_answer(question) for _, question in items])
+
+    if duplicates:
+        print(f'[INFO] removed {len(duplicates)} near-duplicate questions')
+        for quiz in quizzes:
+            quiz['questions'] = []
+        for index, (q, question) in enumerate(items):
+            if index not in duplicates:
+                quizzes[q]['questions'].append(question)
+
+    removed = [items[index][1] for index in sorted(duplicates, key=duplicates.get)]
+    return [quiz for quiz in quizzes if quiz['questions']], removed
@@ -0,0 +1,82 @@
+import json
+import random
+import urllib.parse
+
+from api.parse_hrefs import ar, r
+
+# keys every question item needs (see prompt template in lm_quiz_generation.py)
+QUESTION_KEYS = ['question', 'correct_answer', 'options', 'explanation', 'answer_location', 'href',
+                 'question_number']
+
+
+def is_valid_question(question):
+    """
+    Check if a question item contains all necessary keys.
+    """
+    return all(question.get(key) for key in QUESTION_KEYS)
+
+
+def book_id_from_url(url):
+    """
+    Get the id of a book (the object key on Spaces, based on the content hash) from its presigned URL, which changes
+    every time it is created.
+    """
+    return urllib.parse.unquote(urllib.parse.urlsplit(url).path.rsplit('/', 1)[-1])
+
+
+def bank_key(book_id, href):
+    return f'quiz_bank:{book_id}:{href}'
+
+
+def has_question_bank(book_id, href):
+    return r.exists(bank_key(book_id, href)) > 0
+
+
+def store_question_bank(book_id, href, questions, model_used, total_tokens):
+    """
+    Store pre-generated questions for one href of a book (see batch_generate.py).
+    """
+    bank = {'questions': questions, 'model_used': model_used, 'total_tokens': total_tokens}
+    r.set(bank_key(book_id, href), json.dumps(bank))
+
+
+def selected_bank_keys(url, selected_hrefs):
+    """
+    Get the Redis keys of the question banks needed for the selected hrefs of a book.
+    """
+    book_id = book_id_from_url(url)
+
+    # if both parent and child are selected, the parent bank already covers the child (same as in get_content_async)
+    hrefs = [href for href in selected_hrefs if not ('#' in href and href.split('#')[0] in selected_hrefs)]
+    return [bank_key(book_id, href) for href in hrefs]
+
+
+def build_quiz(banks, num_questions):
+    """
+    Build a quiz from question banks (JSON strings or bytes from Redis, None if missing). Empty banks (very short
+    chapters) contribute no questions. Returns None if a bank is missing or if there are not enough questions, so that
+    the quiz is generated with the LLM instead.
+    """
+    if not banks or any(bank is None for bank in banks):
+        return None
+    banks = [json.loads(bank) for bank in banks]
+
+    questions = [question for bank in banks for question in bank['questions']]
+    if len(questions) < num_questions:
+        return None
+
+    questions = random.sample(questions, num_questions)
+    for number, question in enumerate(questions, start=1):
+        question['question_number'] = number
+
+    return {'questions': questions,
+            'model_used': next((bank['model_used'] for bank in banks if bank['questions']), banks[0]['model_used']),
+            'total_tokens': sum(bank['total_tokens'] for bank in banks)}
+
+
+async def quiz_from_banks_async(url, selected_hrefs, num_questions):
+    """
+    Build a quiz from the question banks of the selected hrefs, or None if they are not all pre-generated.
+    """
+    keys = selected_bank_keys(url, selected_hrefs)
+    return build_quiz(await ar.mget(keys) if keys else [], num_questions)
@@ -0,0 +1,108 @@
+import hashlib
+import os
+import uuid
+import boto3
+from botocore.exceptions import ClientError
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# s3 client for digitalocean spaces
+session = boto3.session.Session()
+client = session.client('s3',
+                        region_name='fra1',
+                        endpoint_url='https://nyc3.digitaloceanspaces.com',
+                        aws_access_key_id=os.getenv('SPACES_KEY'),
+                        aws_secret_access_key=os.getenv('SPACES_SECRET'))
+
+# spaces bucket name
+BUCKET_NAME = os.getenv('BUCKET_NAME')
+
+MAX_UPLOAD_SIZE = 200 * 1024 * 1024  # 200 MB, large enough for image-heavy textbooks
+
+
+def book_key(sha256):
+    """
+    Object key of a book on Spaces: the SHA-256 hash of its content, so the same book is only stored once.
+    """
+    return f'{sha256}.epub'
+
+
+def upload_key(upload_id):
+    """
+    Object key where the browser uploads a book before its hash is checked (not shared with other users). Uploads
+    that are never completed should be removed with a lifecycle rule for the "uploads/" prefix of the Space.
+    """
+    return f'uploads/{upload_id}.epub'
+
+
+def new_upload_id():
+    return uuid.uuid4().hex
+
+
+def file_sha256(path):
+    """
+    SHA-256 hash of a local file as hex string (same as the hash the browser computes before uploading).
+    """
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def object_sha256(key):
+    """
+    SHA-256 hash of an object on Spaces as hex string, streamed so that large books are not read into memory.
+    """
+    sha256 = hashlib.sha256()
+    for block in client.get_object(Bucket=BUCKET_NAME, Key=key)['Body'].iter_chunks(1024 * 1024):
+        sha256.update(block)
+    return sha256.hexdigest()
+
+
+def book_exists(key):
+    """
+    Check if an object is stored on Spaces already.
+    """
+    try:
+        client.head_object(Bucket=BUCKET_NAME, Key=key)
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise
+
+
+def move_object(source, key):
+    """
+    Move an object within the bucket (server-side copy, the file is not downloaded).
+    """
+    client.copy_object(Bucket=BUCKET_NAME, Key=key, CopySource={'Bucket': BUCKET_NAME, 'Key': source},
+                       ContentType='application/epub+zip', MetadataDirective='REPLACE')
+    delete_object(source)
+
+
+def delete_object(key):
+    client.delete_object(Bucket=BUCKET_NAME, Key=key)
+
+
+def presigned_upload(key):
+    """
+    Create a presigned POST, so that the browser can upload the book directly to Spaces (returns url and fields).
+    """
+    return client.generate_presigned_post(BUCKET_NAME, key,
+                                          Fields={'Content-Type': 'application/epub+zip'},
+                                          Conditions=[{'Content-Type': 'application/epub+zip'},
+                                                      ['content-length-range', 1, MAX_UPLOAD_SIZE]],
+                                          ExpiresIn=3600)  # 1 hour
+
+
+def presigned_download(key):
+    """
+    Create a presigned URL to read the book (for the reader and get_content_async).
+    """
+    return client.generate_presigned_url('get_object',
+                                         Params={'Bucket': BUCKET_NAME,
+                                                 'Key': key},
+                                         ExpiresIn=3600 * 24)  # 24 hours
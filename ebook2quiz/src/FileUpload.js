@@ -15,33 +15,48 @@ function FileUpload({onUpload}) {
 
     const navigate = useNavigate(); // to navigate to other page
 
+    // SHA-256 hash of the file content, used as file name on Spaces once the server has checked it
+    // (so every book is stored only once)
+    async function hashFile(file) {
+        const digest = await crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+        return Array.from(new Uint8Array(digest)).map(b => b.toString(16).padStart(2, '0')).join('');
+    }
+
     async function handleSubmit(event) {
         event.preventDefault(); // prevent refresh
         const file = fileInput.current.files[0];
 
-        // create FormData object to send file
-        const formData = new FormData();
-        formData.append('file', file);
-        formData.append('check_validity', checkValidity);
-
         setIsLoading(true); // show loading modal
 
         try {
-            // make POST request to send file to server (and to later upload it there on Spaces)
-            const response = await axios.post('/api/upload', formData, {
-                headers: {
-                    'Content-Type': 'multipart/form-data'
-                }
+            const sha256 = await hashFile(file);
+
+            // ask server for an upload URL (or whether the book was uploaded before)
+            const response = await axios.post('/api/upload', {sha256: sha256});
+
+            if (!response.data.exists) {
+                // upload file directly to Spaces, the form fields from the server have to come before the file
+                const formData = new FormData();
+                Object.entries(response.data.upload.fields).forEach(([key, value]) => formData.append(key, value));
+                formData.append('file', file);
+                await axios.post(response.data.upload.url, formData);
+            }
+
+            // let server check the upload (and validate it if the user wants to)
+            const complete = await axios.post('/api/upload/complete', {
+                sha256: sha256,
+                upload_id: response.data.upload_id,
+                check_validity: checkValidity
             });
 
             // call onUpload with file URL from server
             // (currently the url expires after 24h)
-            onUpload(response.data.file_url); // sets file URL for the reader to access later
+            onUpload(complete.data.file_url); // sets file URL for the reader to access later
 
             // navigate to /view
             navigate('/view');
         } catch (error) {
-            if (error.response.status === 422) { // if epub file is invalid
+            if (error.response && error.response.status === 422) { // if epub file is invalid
                 setErrorMessage(error.response.data.message);  // set error message from server
                 setErrorOpen(true); // open modal with error message
             } else { // other errors